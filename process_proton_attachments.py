@@ -2,28 +2,66 @@
 
 import os
 import json
+import pickle
 import argparse
 import subprocess
-from datetime import datetime, timezone
+import threading
+import calendar
 import time
 import re
-import signal
+import secrets
 import sys
 import shutil
 from pathlib import Path
 from typing import Optional, List, Dict, Any
-from functools import wraps
+from concurrent.futures import ThreadPoolExecutor, as_completed
 
 from dotenv import load_dotenv
 import logging
 from protonmail import ProtonMail
 from protonmail.models import Message, Attachment, Label
+from protonmail.exceptions import LoadSessionError
+
+try:
+    import orjson
+except ImportError:
+    # orjson is an optional speedup; fall back to the standard library parser
+    orjson = None
 
 # Load environment variables
 load_dotenv()
 
 # Constants
 DATE_FORMAT = "%Y-%m-%dT%H:%M:%SZ"
+# Number of messages processed in parallel; keep this low to stay within provider limits
+DEFAULT_CONCURRENCY = 5
+# Where the authenticated session is cached between runs
+DEFAULT_SESSION_FILE = "~/.cache/proton_session.pkl"
+# Proton API response code for a successful request
+PROTON_API_SUCCESS = 1000
+# Start of the message the client raises when it can't refresh the session tokens
+TOKEN_REFRESH_ERROR = "Can't update tokens"
+# Buffer and chunk size used when writing attachments to disk
+WRITE_BUFFER_SIZE = 2 * 1024 * 1024
+# Number of message headers requested per page when listing new messages
+MESSAGES_PAGE_SIZE = 50
+# Maximum number of attachments fetched per download_files call
+DOWNLOAD_BATCH_SIZE = 16
+
+# Seconds to wait for the 1Password CLI before killing it
+OP_TIMEOUT = 300
+
+# How long credentials from 1Password are reused, in seconds
+CREDENTIALS_CACHE_TTL = 25 * 60
+# TOTP codes rotate on fixed 30 second windows of the wall clock
+TOTP_PERIOD = 30
+
+# Attachment extensions (lower case, without the dot) that are saved to the drop folder
+WANTED_EXTENSIONS = frozenset({'pdf', 'zip'})
+
+# Filename sanitising tables, built once since they run for every attachment
+INVALID_FILENAME_CHARS_TABLE = dict.fromkeys(map(ord, '<>:"/\\|?*'))
+DASH_RUN_RE = re.compile(r'[\s-]+')
 
 # Configure logging
 logging.basicConfig(
@@ -33,54 +71,79 @@ logging.basicConfig(
 )
 logger = logging.getLogger(__name__)
 
-# Timeout decorator
-def timeout(seconds=10, error_message="Function call timed out"):
-    def decorator(func):
-        def _handle_timeout(signum, frame):
-            raise TimeoutError(error_message)
-
-        @wraps(func)
-        def wrapper(*args, **kwargs):
-            signal.signal(signal.SIGALRM, _handle_timeout)
-            signal.alarm(seconds)
-            try:
-                result = func(*args, **kwargs)
-            finally:
-                signal.alarm(0)
-            return result
-        return wrapper
-    return decorator
+# (time.time() the entry expires at, credentials) from the last 1Password call
+_CREDENTIALS_CACHE: Optional[tuple] = None
 
 def sanitize_filename(filename: str) -> str:
     """Remove invalid characters from filename."""
     # Remove or replace invalid filename characters
-    filename = re.sub(r'[<>:"/\\|?*]', '', filename)
+    filename = filename.translate(INVALID_FILENAME_CHARS_TABLE)
     # Replace spaces and multiple dashes with single dash
-    filename = re.sub(r'[\s-]+', '-', filename)
+    filename = DASH_RUN_RE.sub('-', filename)
     return filename.strip('-')
 
+def json_loads(data: str) -> Any:
+    """Parse JSON, using orjson when it is installed."""
+    # orjson.JSONDecodeError subclasses json.JSONDecodeError, so callers can catch either
+    if orjson:
+        return orjson.loads(data)
+    return json.loads(data)
+
+def json_dumps(obj: Any) -> str:
+    """Serialize to JSON, using orjson when it is installed."""
+    if orjson:
+        return orjson.dumps(obj).decode()
+    return json.dumps(obj)
+
 def load_last_check_date(config_file="last_check.json") -> Optional[str]:
     """Load the last check date from config file."""
     try:
         with open(config_file, 'r') as f:
-            data = json.load(f)
+            data = json_loads(f.read())
             return data.get('last_check')
     except (FileNotFoundError, json.JSONDecodeError):
         return None
 
 def save_last_check_date(date: str, config_file="last_check.json") -> None:
     """Save the last check date to config file."""
-    with open(config_file, 'w') as f:
-        json.dump({'last_check': date}, f)
+    # Write to a temp file and rename over the original so a crash never leaves it truncated
+    tmp_file = Path(f"{config_file}.tmp")
+    tmp_file.write_text(json_dumps({'last_check': date}))
+    os.replace(tmp_file, config_file)
+
+def open_dir_fd(folder: Path) -> Optional[int]:
+    """Open a directory fd for relative file creation, or None where unsupported."""
+    # os.replace uses the same renameat() support that os.rename advertises
+    if os.open not in os.supports_dir_fd or os.rename not in os.supports_dir_fd:
+        return None
+    return os.open(folder, os.O_RDONLY | getattr(os, 'O_DIRECTORY', 0))
+
+def save_attachment(folder: Path, filename: str, content: bytes, dir_fd: Optional[int] = None) -> None:
+    """Write attachment content to disk in buffer-sized chunks."""
+    # Write to a temp name and rename it into place, so an interrupted write never
+    # leaves a truncated file under the final name (which later runs would skip).
+    # The temp name is short and fixed-length so long attachment names still fit.
+    tmp_filename = f".{secrets.token_hex(8)}.part"
+    # With a directory fd, create and rename relative to it to skip resolving the full path
+    tmp_path, final_path = (tmp_filename, filename) if dir_fd is not None else (folder / tmp_filename, folder / filename)
+    # Slicing a memoryview avoids copying the (possibly multi-MB) payload
+    view = memoryview(content)
+    fd = os.open(tmp_path, os.O_WRONLY | os.O_CREAT | os.O_EXCL, 0o666, dir_fd=dir_fd)
+    try:
+        with os.fdopen(fd, 'wb', buffering=WRITE_BUFFER_SIZE) as f:
+            for offset in range(0, len(view), WRITE_BUFFER_SIZE):
+                f.write(view[offset:offset + WRITE_BUFFER_SIZE])
+    except BaseException:
+        os.unlink(tmp_path, dir_fd=dir_fd)
+        raise
+    os.replace(tmp_path, final_path, src_dir_fd=dir_fd, dst_dir_fd=dir_fd)
 
 def get_timestamp_from_iso(iso_date: Optional[str]) -> Optional[int]:
     """Convert ISO date string to timestamp."""
     if not iso_date:
         return None
     try:
-        dt = datetime.strptime(iso_date, DATE_FORMAT)
-        dt = dt.replace(tzinfo=timezone.utc)
-        return int(dt.timestamp())
+        return calendar.timegm(time.strptime(iso_date, DATE_FORMAT))
     except ValueError:
         return None
 
@@ -93,8 +156,25 @@ def get_2fa_code():
     print("="*50 + "\n")
     return code
 
-@timeout(300, "ProtonMail processing timed out after 5 minutes")
 def get_proton_credentials() -> Dict[str, Any]:
+    """Get Proton Mail credentials, reusing a recent 1Password lookup if possible."""
+    global _CREDENTIALS_CACHE
+    if _CREDENTIALS_CACHE:
+        expires_at, credentials = _CREDENTIALS_CACHE
+        if time.time() < expires_at:
+            return credentials
+
+    credentials = fetch_proton_credentials()
+    now = time.time()
+    if credentials["totp"]:
+        # A cached TOTP code is only valid until the end of the window it was generated in
+        expires_at = now + TOTP_PERIOD - now % TOTP_PERIOD
+    else:
+        expires_at = now + CREDENTIALS_CACHE_TTL
+    _CREDENTIALS_CACHE = (expires_at, credentials)
+    return credentials
+
+def fetch_proton_credentials() -> Dict[str, Any]:
     """Get Proton Mail credentials from 1Password CLI."""
     try:
         op_executable = shutil.which("op")
@@ -106,11 +186,13 @@ def get_proton_credentials() -> Dict[str, Any]:
             [op_executable, "item", "get", "Proton", "--vault", "Private", "--format", "json"],
             capture_output=True,
             text=True,
-            check=True
+            check=True,
+            # Killing 'op' on timeout keeps a hung CLI (e.g. waiting on unlock) from blocking the run
+            timeout=OP_TIMEOUT
         )
         
         # Parse the JSON output
-        item_data = json.loads(result.stdout)
+        item_data = json_loads(result.stdout)
         
         # Extract the credentials
         credentials = {
@@ -133,6 +215,10 @@ def get_proton_credentials() -> Dict[str, Any]:
         
         return credentials
     
+    except subprocess.TimeoutExpired:
+        message = f"1Password CLI timed out after {OP_TIMEOUT} seconds"
+        logger.error(message)
+        raise TimeoutError(message) from None
     except subprocess.CalledProcessError as e:
         logger.error(f"Error running 1Password CLI: {e}")
         logger.error(f"Stdout: {e.stdout}")
@@ -145,15 +231,110 @@ def get_proton_credentials() -> Dict[str, Any]:
         logger.error(f"Unexpected error: {e}")
         raise
 
-def process_emails(proton_folder=None, drop_folder=None, config_file="last_check.json"):
-    """Main function to process emails and save attachments."""
+def load_session(client: ProtonMail, session_file: Path) -> bool:
+    """Resume a saved ProtonMail session, returning True if it is still valid.
+
+    The saved session is only discarded when it is unreadable or its tokens are
+    rejected; network errors propagate so a flaky connection doesn't force a
+    fresh login with 2FA.
+    """
+    if not session_file.exists():
+        return False
+    try:
+        client.load_session(str(session_file), auto_save=True)
+        # Cheap authenticated call; expired access tokens are refreshed here
+        user_info = client.get_user_info()
+    except (LoadSessionError, pickle.UnpicklingError, EOFError) as e:
+        reason = f"unreadable session file: {e}"
+    except Exception as e:
+        # The client raises a bare Exception when the refresh token is rejected
+        if not str(e).startswith(TOKEN_REFRESH_ERROR):
+            raise
+        reason = str(e)
+    else:
+        if user_info.get('Code') != PROTON_API_SUCCESS:
+            raise RuntimeError(f"Could not verify saved session: {user_info.get('Error', user_info)}")
+        return True
+
+    logger.warning(f"Saved session is no longer valid, logging in again: {reason}")
+    session_file.unlink(missing_ok=True)
+    return False
+
+def save_session(client: ProtonMail, session_file: Path) -> None:
+    """Persist the ProtonMail session so the next run can skip the login."""
+    session_file.parent.mkdir(parents=True, exist_ok=True)
+    # The session holds auth tokens, so make the file private before anything is written to it
+    os.close(os.open(session_file, os.O_WRONLY | os.O_CREAT, 0o600))
+    os.chmod(session_file, 0o600)  # in case it already existed with a looser mode
+    client.save_session(str(session_file))
+
+def login(client: ProtonMail) -> None:
+    """Log in to ProtonMail with credentials from 1Password."""
     # Get credentials from 1Password
     logger.info("Getting credentials from 1Password...")
     credentials = get_proton_credentials()
     username = credentials["username"]
     password = credentials["password"]
     totp_code = credentials["totp"]
-    
+
+    # Login to ProtonMail
+    logger.info(f"Logging in as {username}...")
+    # If we have a TOTP code from 1Password, create a function that returns it
+    if totp_code:
+        logger.info("Using 2FA code from 1Password")
+        def get_2fa_from_1password():
+            logger.info(f"Using 2FA code: {totp_code}")
+            return totp_code
+        client.login(username, password, getter_2fa_code=get_2fa_from_1password)
+    else:
+        # Fall back to manual 2FA input
+        logger.info("No 2FA code from 1Password, will prompt for manual input")
+        client.login(username, password, getter_2fa_code=get_2fa_code)
+    logger.info("Login successful")
+
+def may_have_attachments(msg: Message) -> bool:
+    """Check the listing metadata of a message for attachments.
+
+    The client keeps the raw listing response in ``msg.extra``; only messages
+    that explicitly report zero attachments are treated as attachment-free.
+    """
+    num_attachments = msg.extra.get('NumAttachments')
+    return num_attachments is None or num_attachments > 0
+
+def get_messages_since(client: ProtonMail, label_id: str, since: int) -> List[Message]:
+    """Get messages in a label newer than the given timestamp.
+
+    The client's paged listing can't filter by label or date, so this queries
+    the messages endpoint through the client's request helper with ``Begin``
+    set. Pages come back newest first, so paging also stops at the first page
+    that reaches back past the timestamp.
+
+    ``_get`` and ``_convert_dict_to_message`` are client internals, checked
+    against the protonmail-api-client version pinned in requirements.txt.
+    """
+    messages = []
+    page = 0
+    while True:
+        response = client._get('mail', 'mail/v4/messages', params={
+            "Page": page,
+            "PageSize": MESSAGES_PAGE_SIZE,
+            "Limit": MESSAGES_PAGE_SIZE,
+            "LabelID": label_id,
+            "Begin": since,
+            "Sort": "Time",
+            "Desc": 1,
+        })
+        response.raise_for_status()
+        batch = response.json()['Messages']
+        messages.extend(
+            ProtonMail._convert_dict_to_message(msg) for msg in batch if msg['Time'] > since
+        )
+        if len(batch) < MESSAGES_PAGE_SIZE or any(msg['Time'] <= since for msg in batch):
+            return messages
+        page += 1
+
+def process_emails(proton_folder=None, drop_folder=None, config_file="last_check.json"):
+    """Main function to process emails and save attachments."""
     # Use command-line arguments if provided, otherwise fall back to environment variables
     label_path = proton_folder or os.getenv('PROTON_FOLDER')
     logger.info(f"Looking for label with path: '{label_path}'")
@@ -162,36 +343,33 @@ def process_emails(proton_folder=None, drop_folder=None, config_file="last_check
     drop_folder = Path(drop_folder_path)
     logger.info(f"Using drop folder: '{drop_folder}'")
 
-    if not all([username, password, label_path]):
-        raise ValueError("Missing required credentials or folder information")
+    if not label_path:
+        raise ValueError("Missing required folder information")
 
     # Create drop folder if it doesn't exist
     drop_folder.mkdir(parents=True, exist_ok=True)
 
+    session_file = Path(os.getenv('PROTON_SESSION_FILE', DEFAULT_SESSION_FILE)).expanduser()
+
     # Initialize ProtonMail client
     logger.info("Initializing ProtonMail client...")
     client = ProtonMail(logging_level=2)  # 2 = INFO level
     
+    # Reuse the session from a previous run if possible, otherwise log in.
+    # Done outside the try below so credential and login failures exit non-zero.
+    if load_session(client, session_file):
+        logger.info(f"Resumed session from {session_file}")
+    else:
+        login(client)
+        save_session(client, session_file)
+        # Only load_session turns on auto-save, so refreshed tokens from this run are kept too
+        client.load_session(str(session_file), auto_save=True)
+    
     try:
-        # Login to ProtonMail
-        logger.info(f"Logging in as {username}...")
-        # If we have a TOTP code from 1Password, create a function that returns it
-        if totp_code:
-            logger.info("Using 2FA code from 1Password")
-            def get_2fa_from_1password():
-                logger.info(f"Using 2FA code: {totp_code}")
-                return totp_code
-            client.login(username, password, getter_2fa_code=get_2fa_from_1password)
-        else:
-            # Fall back to manual 2FA input
-            logger.info("No 2FA code from 1Password, will prompt for manual input")
-            client.login(username, password, getter_2fa_code=get_2fa_code)
-        logger.info("Login successful")
-        
         # Get last check date
         last_check_iso = load_last_check_date(config_file)
         last_check_timestamp = get_timestamp_from_iso(last_check_iso)
-        current_time = datetime.now(timezone.utc).strftime(DATE_FORMAT)
+        current_time = time.strftime(DATE_FORMAT, time.gmtime())
         
         logger.info(f"Last check date: {last_check_iso or 'Never'}")
         
@@ -200,43 +378,29 @@ def process_emails(proton_folder=None, drop_folder=None, config_file="last_check
         user_labels = client.get_all_labels()
         
         # Log all available labels for debugging
-        logger.info("Available labels:")
-        for label in user_labels:
-            logger.info(f"  - {label.name} (ID: {label.id}, Path: {getattr(label, 'path', 'N/A')})")
-        
-        # Find the label that matches the path
-        target_label = None
+        if logger.isEnabledFor(logging.DEBUG):
+            logger.debug("Available labels:")
+            for label in user_labels:
+                logger.debug("  - %s (ID: %s, Path: %s)", label.name, label.id, getattr(label, 'path', 'N/A'))
         
-        # First try exact match
+        # Index labels by name once; setdefault keeps the first match like a linear scan would
+        labels_by_name = {}
+        labels_by_lower_name = {}
         for label in user_labels:
-            if label.name == label_path:
-                target_label = label
-                break
+            labels_by_name.setdefault(label.name, label)
+            labels_by_lower_name.setdefault(label.name.lower(), label)
         
-        # If not found, try case-insensitive match
-        if not target_label:
-            for label in user_labels:
-                if label.name.lower() == label_path.lower():
-                    target_label = label
-                    break
+        # First try exact match, then case-insensitive match
+        target_label = labels_by_name.get(label_path) or labels_by_lower_name.get(label_path.lower())
         
-        # If still not found, try to match with path parts
+        # If still not found, try to find a label that contains all parts of the path
         if not target_label:
-            path_parts = label_path.split('/')
-            
-            # Try to find a label that contains all parts of the path
-            for label in user_labels:
-                label_name_lower = label.name.lower()
-                all_parts_match = True
-                
-                for part in path_parts:
-                    if part.lower() not in label_name_lower:
-                        all_parts_match = False
-                        break
-                
-                if all_parts_match:
-                    target_label = label
-                    break
+            path_parts_lower = [part.lower() for part in label_path.split('/')]
+            target_label = next(
+                (label for name, label in labels_by_lower_name.items()
+                 if all(part in name for part in path_parts_lower)),
+                None
+            )
         
         if not target_label:
             raise ValueError(f"Label '{label_path}' not found")
@@ -245,49 +409,108 @@ def process_emails(proton_folder=None, drop_folder=None, config_file="last_check
         
         # Get messages with the specified label
         logger.info(f"Getting messages with label '{target_label.name}'...")
-        messages = client.get_messages(label_or_id=target_label.id)
-        
-        # Filter messages by date if we have a last check date
         if last_check_timestamp:
-            messages = [msg for msg in messages if msg.time > last_check_timestamp]
+            # Only page through messages newer than the last check
+            messages = get_messages_since(client, target_label.id, last_check_timestamp)
+        else:
+            messages = client.get_messages(label_or_id=target_label.id)
         
         logger.info(f"Found {len(messages)} new messages")
         
-        # Process messages
-        for msg in messages:
+        # Only fetch full messages that the listing doesn't already show as attachment-free
+        messages = [msg for msg in messages if may_have_attachments(msg)]
+        logger.info(f"{len(messages)} new messages may have attachments")
+        
+        # Snapshot the drop folder once so each attachment check is a set lookup
+        existing_files = {path.name for path in drop_folder.iterdir()}
+        
+        # The client isn't thread-safe: every request clears and rebuilds its cookie jar,
+        # and token refreshes spend a single-use refresh token. Serialise all client calls.
+        client_lock = threading.Lock()
+        
+        # Prepare messages on worker threads; only one talks to Proton at a time
+        def _collect_pending(msg):
             # Read the message to get its content and attachments
-            full_msg = client.read_message(msg)
+            with client_lock:
+                full_msg = client.read_message(msg)
             
             # Get sender information
             sender_name = full_msg.sender.name or full_msg.sender.address
             sender = sanitize_filename(sender_name)
             
             # Format date
-            msg_time = datetime.fromtimestamp(full_msg.time, timezone.utc)
-            date_str = msg_time.strftime('%Y%m%d')
+            msg_time = time.gmtime(full_msg.time)
+            date_str = f"{msg_time.tm_year:04d}{msg_time.tm_mon:02d}{msg_time.tm_mday:02d}"
+            
+            # Work out target filenames up front so already-saved files are not downloaded again
+            pending = []
+            for attachment in full_msg.attachments:
+                # Check if it's a PDF or ZIP file
+                _, dot, ext = attachment.name.lower().rpartition('.')
+                if not dot or ext not in WANTED_EXTENSIONS:
+                    continue
+                
+                # Create filename
+                filename = f"{date_str}-{sender}-{sanitize_filename(attachment.name)}"
+                if filename in existing_files:
+                    logger.info(f"Skipping attachment already in drop folder: {filename}")
+                    continue
+                pending.append((filename, ext.upper(), attachment))
             
-            # Check if message has attachments
-            if full_msg.attachments:
-                logger.info(f"Message '{full_msg.subject}' has {len(full_msg.attachments)} attachments")
+            if pending:
+                logger.info(f"Message '{full_msg.subject}' has {len(pending)} new attachments")
+            return pending
+        
+        # Save a downloaded batch; runs on its own thread so disk writes overlap downloads
+        def _save_batch(batch, attachments):
+            for (filename, file_type, _), attachment in zip(batch, attachments):
+                logger.info(f"Processing {file_type} attachment: {attachment.name}")
                 
-                # Download attachments
-                attachments = client.download_files(full_msg.attachments)
+                # Save attachment
+                save_attachment(drop_folder, filename, attachment.content, dir_fd)
                 
-                for attachment in attachments:
-                    # Check if it's a PDF or ZIP file
-                    if attachment.name.lower().endswith(('.pdf', '.zip')):
-                        file_type = "PDF" if attachment.name.lower().endswith('.pdf') else "ZIP"
-                        logger.info(f"Processing {file_type} attachment: {attachment.name}")
+                logger.info(f"Saved attachment: {filename}")
+        
+        # Download a batch of attachments, possibly from several messages, in one call;
+        # the client fetches the batch concurrently, so it needs no parallel callers
+        def _download_batch(batch):
+            with client_lock:
+                attachments = client.download_files([attachment for _, _, attachment in batch])
+            return writer.submit(_save_batch, batch, attachments)
+        
+        # Hold the drop folder open so each attachment is created relative to it
+        dir_fd = open_dir_fd(drop_folder)
+        
+        # Pipeline: read messages -> download attachments (both on the bounded pool) -> write to disk
+        try:
+            max_workers = int(os.getenv('PROTON_CONCURRENCY', DEFAULT_CONCURRENCY))
+            # Nested so the pool finishes (and stops submitting writes) before the writer shuts down
+            with ThreadPoolExecutor(max_workers=1) as writer:
+                with ThreadPoolExecutor(max_workers=max_workers) as pool:
+                    try:
+                        reads = [pool.submit(_collect_pending, msg) for msg in messages]
                         
-                        # Create filename
-                        filename = f"{date_str}-{sender}-{sanitize_filename(attachment.name)}"
-                        file_path = drop_folder / filename
+                        # Start downloading as soon as a full batch of attachments has been collected
+                        downloads = []
+                        batch = []
+                        for read in as_completed(reads):
+                            batch.extend(read.result())
+                            while len(batch) >= DOWNLOAD_BATCH_SIZE:
+                                downloads.append(pool.submit(_download_batch, batch[:DOWNLOAD_BATCH_SIZE]))
+                                batch = batch[DOWNLOAD_BATCH_SIZE:]
+                        if batch:
+                            downloads.append(pool.submit(_download_batch, batch))
                         
-                        # Save attachment
-                        with open(file_path, 'wb') as f:
-                            f.write(attachment.content)
-                            
-                        logger.info(f"Saved attachment: {filename}")
+                        # Wait for each download and then for its write, surfacing any errors
+                        for download in downloads:
+                            download.result().result()
+                    except BaseException:
+                        # Don't start queued reads or downloads once the run has failed
+                        pool.shutdown(cancel_futures=True)
+                        raise
+        finally:
+            if dir_fd is not None:
+                os.close(dir_fd)
         
         # Save current time as last check date
         save_last_check_date(current_time, config_file)